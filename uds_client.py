@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 import can
+import hashlib
+import sys
 import time
 
-bus = can.interface.Bus(channel='vcan0', bustype='socketcan')
+bus = can.interface.Bus(channel='vcan0', bustype='socketcan', can_filters=[{"can_id": 0x7E8, "can_mask": 0x7FF}])
+
+FIRMWARE_ADDRESS = 0x08010000
+HASH_LENGTH = 8                 # Truncated SHA-256 per block, as reported by DID F1A0
 
 print("Starting UDS session...\n")
 
@@ -45,8 +50,6 @@ bus.send(can.Message(arbitration_id=0x7E0, data=[0x3E, 0x00], is_extended_id=Fal
 print("→ 3E 00 Tester present")
 time.sleep(0.5)
 
-print("\n=== STARTING ECU FLASHING (50 KB firmware) ===\n")
-
 def send_uds_long(payload):
     """Send any UDS payload using proper ISO-TP (max 8 bytes per CAN frame)"""
     if len(payload) <= 7:  # Single frame (0x00-0x07)
@@ -76,37 +79,130 @@ def send_uds_long(payload):
         i += 7
         time.sleep(0.005)
 
-# 0x34 Request Download – NOW CORRECT (12 bytes total → split properly)
-req_download = bytearray([
-    0x34, 0x00,           # SID + subfunction
-    0x44,                 # lengthFormat (4) + addressFormat (4)
-    0x00, 0x00, 0xC3, 0x50,  # length = 50000
-    0x14,                 # addressFormatIdentifier
-    0x08, 0x01, 0x00, 0x00   # address = 0x08010000
-])
-send_uds_long(req_download)
-print("34 Request Download: 50000 bytes @ 0x08010000")
-time.sleep(1.5)
-
-# 0x36 Transfer Data – 13 blocks of ~3846 bytes
-total_sent = 0
-seq = 1
-while total_sent < 50000:
-    remaining = 50000 - total_sent
-    block_size = min(3846, remaining)
-    dummy_data = bytes([seq % 256] * block_size)
-
-    payload = bytearray([0x36, seq % 256]) + dummy_data
+def recv_uds(timeout=2.0):
+    """Receive one ECU response (raw SF or FF/CF), waiting longer after 7F xx 78"""
+    deadline = time.time() + timeout
+    buffer = None
+    expected = 0
+    while time.time() < deadline:
+        msg = bus.recv(timeout=max(0.0, deadline - time.time()))
+        if not msg:
+            continue
+        data = msg.data
+        if data[0] >> 4 == 0x1:  # First frame
+            expected = ((data[0] & 0x0F) << 8) | data[1]
+            buffer = bytearray(data[2:8])
+            continue
+        if data[0] >> 4 == 0x2 and buffer is not None:  # Consecutive frame
+            buffer.extend(data[1:8])
+            if len(buffer) >= expected:
+                return bytes(buffer[:expected])
+            continue
+        if len(data) >= 3 and data[0] == 0x7F and data[2] == 0x78:  # responsePending
+            deadline = time.time() + 5.0
+            continue
+        return bytes(data)
+    return None
+
+def uds_request(payload, timeout=2.0):
+    """Drop stale responses, send the request and wait for its response"""
+    while bus.recv(timeout=0):
+        pass
     send_uds_long(payload)
-
-    total_sent += block_size
-    seq += 1
-    print(f"36 {seq-1:02X} Sent {block_size} bytes → Total: {total_sent}/50000")
-    time.sleep(0.4)
-
-# 0x37 Request Transfer Exit
-bus.send(can.Message(arbitration_id=0x7E0, data=[0x37], is_extended_id=False))
-print("37 Request Transfer Exit")
-time.sleep(1.0)
-
-print("\nECU REPROGRAMMING SUCCESSFUL! 50 KB flashed.")
\ No newline at end of file
+    return recv_uds(timeout)
+
+def download_segment(address, data):
+    """Erase (31 01 FF00) then one 34/36/37 sequence for a contiguous address range"""
+    erase_memory = bytearray([
+        0x31, 0x01, 0xFF, 0x00,  # startRoutine EraseMemory
+        0x44,                    # addressAndLengthFormatIdentifier: 4-byte size, 4-byte address
+    ]) + address.to_bytes(4, 'big') + len(data).to_bytes(4, 'big')
+    resp = uds_request(erase_memory, timeout=5.0)
+    if not resp or resp[:5] != b'\x71\x01\xFF\x00\x02':
+        print(f"31 01 FF00 Erase failed: {resp.hex().upper() if resp else 'timeout'}")
+        return False
+    print(f"31 01 FF00 Erased {int.from_bytes(resp[5:7], 'big')} sector(s) @ 0x{address:08X}")
+
+    req_download = bytearray([
+        0x34, 0x00,           # SID + dataFormatIdentifier (no compression/encryption)
+        0x44,                 # addressAndLengthFormatIdentifier: 4-byte size, 4-byte address
+    ]) + address.to_bytes(4, 'big') + len(data).to_bytes(4, 'big')
+    resp = uds_request(req_download)
+    if not resp or resp[0] != 0x74:
+        print(f"34 Request Download rejected: {resp.hex().upper() if resp else 'timeout'}")
+        return False
+    max_block_length = int.from_bytes(resp[2:2 + (resp[1] >> 4)], 'big')
+    chunk_size = max_block_length - 2     # SID + block sequence counter
+    print(f"34 Request Download: {len(data)} bytes @ 0x{address:08X} (max block {max_block_length})")
+
+    seq = 1
+    for i in range(0, len(data), chunk_size):
+        block = data[i:i + chunk_size]
+        resp = uds_request(bytearray([0x36, seq]) + block)
+        if not resp or resp[0] != 0x76:
+            print(f"36 {seq:02X} Transfer failed: {resp.hex().upper() if resp else 'timeout'}")
+            return False
+        print(f"36 {seq:02X} Sent {len(block)} bytes → {i + len(block)}/{len(data)}")
+        seq = (seq + 1) & 0xFF
+
+    resp = uds_request(b'\x37')
+    print("37 Request Transfer Exit")
+    return bool(resp) and resp[0] == 0x77
+
+def changed_ranges(image):
+    """Compare the image against the ECU block hashes (DID F1A0) → (image, [(offset, end)] to send)
+
+    The returned image is padded with 0xFF to the end of its last block (clamped to
+    the flash end) so a shorter image also clears the stale tail of that block.
+    """
+    resp = uds_request(b'\x22\xF1\xA0', timeout=3.0)
+    block_size = int.from_bytes(resp[7:9], 'big') if resp and len(resp) >= 9 else 0
+    if not block_size or resp[:3] != b'\x62\xF1\xA0':
+        print("22 F1 A0 Block hashes unavailable → full flash")
+        return image, [(0, len(image))]
+    base = int.from_bytes(resp[3:7], 'big')
+    hashes = resp[9:]
+    if (FIRMWARE_ADDRESS - base) % block_size:
+        print("Firmware not block aligned → full flash")
+        return image, [(0, len(image))]
+    first_block = (FIRMWARE_ADDRESS - base) // block_size
+    flash_end = (len(hashes) // HASH_LENGTH - first_block) * block_size
+    padded_end = min(-(-len(image) // block_size) * block_size, max(flash_end, len(image)))
+    image = image + b'\xFF' * (padded_end - len(image))
+
+    ranges = []
+    for offset in range(0, len(image), block_size):
+        block = image[offset:offset + block_size]
+        index = first_block + offset // block_size
+        local = hashlib.sha256(block).digest()[:HASH_LENGTH]
+        if local == hashes[index * HASH_LENGTH:(index + 1) * HASH_LENGTH]:
+            continue
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], offset + len(block))  # Merge adjacent blocks
+        else:
+            ranges.append((offset, offset + len(block)))
+    return image, ranges
+
+# Firmware image: file given on the command line, else the 50 KB demo pattern
+if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as f:
+        firmware = f.read()
+else:
+    firmware = b''.join(bytes([seq % 256] * min(3846, 50000 - off))
+                        for seq, off in enumerate(range(0, 50000, 3846), start=1))
+
+print(f"\n=== STARTING ECU FLASHING ({len(firmware)} bytes firmware) ===\n")
+
+image, ranges = changed_ranges(firmware)
+to_send = sum(end - start for start, end in ranges)
+print(f"{len(ranges)} segment(s) differ: {to_send}/{len(image)} bytes to transfer")
+
+for start, end in ranges:
+    if not download_segment(FIRMWARE_ADDRESS + start, image[start:end]):
+        print("\nECU REPROGRAMMING FAILED!")
+        sys.exit(1)
+
+if ranges:
+    print(f"\nECU REPROGRAMMING SUCCESSFUL! {to_send} bytes flashed in {len(ranges)} segment(s).")
+else:
+    print("\nECU already up to date – nothing flashed.")
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+UDS soak / load generator.
+
+Runs several tester sessions in parallel (one thread + one CAN socket per
+tester address pair), each driving a weighted mix of SIDs at a target request
+rate, optionally with random background traffic on other CAN IDs. Every
+report interval it prints error rates, timeouts and latency percentiles so the
+capacity of uds_server.py / second_server_uds.py can be found before a rig is
+deployed.
+
+Every pair must be served by an ECU: start uds_server.py with the request IDs
+(e.g. `python3 uds_server.py 7E0 7E1 7E2 7E3` for --sessions 4). second_server_uds.py
+only serves 7E0 → 7E8.
+
+Examples:
+    python3 uds_load.py --duration 300 --rate 20
+    python3 uds_load.py --sessions 4 --mix 3E=5,22=3,19=2 --bus-load 800
+    python3 uds_load.py --pairs 7E0:7E8 --framing isotp --csv soak.csv
+"""
+import argparse
+import csv
+import random
+import threading
+import time
+
+import can
+
+# Requests used for each SID in the mix (all fit in a single frame)
+REQUESTS = {
+    0x10: b'\x10\x03',               # Extended session
+    0x22: b'\x22\xF1\x90',           # Read VIN (multi-frame response)
+    0x19: b'\x19\x02\x08',           # Report DTC by status mask
+    0x3E: b'\x3E\x00',               # Tester present
+    0x11: b'\x11\x03',               # Soft reset
+    0x31: b'\x31\x03\xFF\xFB',       # Self-test results
+}
+
+P2_CLIENT = 0.15        # Wait for first response frame
+P2_STAR_CLIENT = 5.5    # Wait after a 0x78 responsePending
+N_CR = 0.5              # Max gap between consecutive frames
+
+
+class Stats:
+    """Thread-safe counters + latencies for one report interval"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.positive = 0
+        self.negative = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.pending = 0
+        self.late = 0           # Responses to earlier, already timed-out requests
+        self.latencies = []
+
+    def record(self, outcome, latency=None, pending=0):
+        with self.lock:
+            self.sent += 1
+            self.pending += pending
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def record_late(self):
+        with self.lock:
+            self.late += 1
+
+    def snapshot(self):
+        with self.lock:
+            snap = dict(sent=self.sent, positive=self.positive, negative=self.negative,
+                        timeouts=self.timeouts, errors=self.errors, pending=self.pending,
+                        late=self.late, latencies=sorted(self.latencies))
+            self.reset()
+        return snap
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class TesterSession(threading.Thread):
+    """One tester on its own TX/RX address pair"""
+
+    def __init__(self, args, tx_id, rx_id, mix, stats, stop):
+        super().__init__(daemon=True)
+        self.tx_id = tx_id
+        self.rx_id = rx_id
+        self.mix = mix
+        self.rate = args.rate
+        self.framing = args.framing
+        self.stats = stats
+        self.stop = stop
+        self.bus = can.interface.Bus(channel=args.channel, bustype=args.bustype,
+                                     can_filters=[{"can_id": rx_id, "can_mask": 0x7FF}])
+
+    def send(self, payload):
+        if self.framing == "isotp":
+            data = bytearray([len(payload)]) + payload + b'\x00' * (7 - len(payload))
+        else:
+            data = payload  # uds_server.py: raw single frame, no PCI
+        self.bus.send(can.Message(arbitration_id=self.tx_id, data=data, is_extended_id=False))
+
+    def recv_frame(self, deadline):
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            msg = self.bus.recv(timeout=remaining)
+            if msg and msg.arbitration_id == self.rx_id:
+                return msg.data
+
+    def recv_response(self, timeout):
+        """Reassemble one response; returns (payload, error) — payload None on timeout"""
+        data = self.recv_frame(time.time() + timeout)
+        if data is None:
+            return None, None
+        pci = data[0] >> 4
+
+        if pci == 0x1:  # First frame
+            expected = ((data[0] & 0x0F) << 8) | data[1]
+            buffer = bytearray(data[2:8])
+            if self.framing == "isotp":
+                fc = bytes([0x30, 0x00, 0x00] + [0x00] * 5)
+                try:
+                    self.bus.send(can.Message(arbitration_id=self.tx_id, data=fc, is_extended_id=False))
+                except can.CanError:
+                    return bytes(buffer), "FC not sent"
+            seq = 1
+            while len(buffer) < expected:
+                cf = self.recv_frame(time.time() + N_CR)
+                if cf is None:
+                    return None, None
+                if cf[0] >> 4 != 0x2 or cf[0] & 0x0F != seq:
+                    return bytes(buffer), "sequence"
+                buffer.extend(cf[1:8])
+                seq = (seq + 1) & 0x0F
+            return bytes(buffer[:expected]), None
+
+        if pci == 0x2:
+            return bytes(data), "unexpected CF"
+        if self.framing == "isotp":
+            return bytes(data[1:1 + (data[0] & 0x0F)]), None
+        return bytes(data), None
+
+    def transact(self, sid):
+        start = time.time()  # Before send, so a blocked TX queue shows up as latency
+        try:
+            self.send(REQUESTS[sid])
+        except can.CanError:
+            self.stats.record("errors")  # TX queue full under bus load
+            return
+        deadline = start + P2_CLIENT
+        pending = 0
+        while True:
+            resp, error = self.recv_response(max(0.0, deadline - time.time()))
+            if resp is None:
+                self.stats.record("timeouts", pending=pending)
+                return
+            if error or not resp:
+                self.stats.record("errors", pending=pending)
+                return
+            if resp[0] != sid + 0x40 and not (len(resp) >= 2 and resp[0] == 0x7F and resp[1] == sid):
+                self.stats.record_late()  # Answer to an earlier request – keep waiting for ours
+                continue
+            if len(resp) >= 3 and resp[0] == 0x7F and resp[2] == 0x78:
+                pending += 1
+                deadline = time.time() + P2_STAR_CLIENT
+                continue
+            latency = time.time() - start
+            if resp[0] == sid + 0x40:
+                self.stats.record("positive", latency, pending)
+            else:
+                self.stats.record("negative", latency, pending)
+            return
+
+    def run(self):
+        sids, weights = zip(*self.mix.items())
+        next_send = time.time()
+        while not self.stop.is_set():
+            self.transact(random.choices(sids, weights)[0])
+            next_send += 1.0 / self.rate
+            delay = next_send - time.time()
+            if delay > 0:
+                self.stop.wait(delay)
+            else:
+                next_send = time.time()  # Behind schedule: don't burst to catch up
+        self.bus.shutdown()
+
+
+def background_traffic(args, stop, reserved_ids):
+    """Random 8-byte frames on non-diagnostic IDs at --bus-load frames/s"""
+    bus = can.interface.Bus(channel=args.channel, bustype=args.bustype)
+    ids = [i for i in range(0x100, 0x700) if i not in reserved_ids]
+    interval = 1.0 / args.bus_load
+    next_send = time.time()
+    while not stop.is_set():
+        data = bytes(random.getrandbits(8) for _ in range(8))
+        try:
+            bus.send(can.Message(arbitration_id=random.choice(ids), data=data, is_extended_id=False))
+        except can.CanError:
+            pass  # TX queue full – that is what bus load looks like
+        next_send += interval
+        delay = next_send - time.time()
+        if delay > 0:
+            stop.wait(delay)
+        else:
+            next_send = time.time()  # Behind schedule: don't burst above --bus-load
+    bus.shutdown()
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        sid, _, weight = item.partition('=')
+        sid = int(sid, 16)
+        if sid not in REQUESTS:
+            raise argparse.ArgumentTypeError(f"unsupported SID {sid:02X} (choose from "
+                                             f"{', '.join(f'{s:02X}' for s in REQUESTS)})")
+        mix[sid] = float(weight or 1)
+    return mix
+
+
+def positive_float(text):
+    value = float(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f"must be > 0, got {text}")
+    return value
+
+
+def non_negative_float(text):
+    value = float(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"must be >= 0, got {text}")
+    return value
+
+
+def parse_pairs(text):
+    pairs = []
+    for item in text.split(','):
+        tx, _, rx = item.partition(':')
+        pairs.append((int(tx, 16), int(rx, 16)))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-tester UDS soak / load generator")
+    parser.add_argument("--channel", default="vcan0")
+    parser.add_argument("--bustype", default="socketcan")
+    parser.add_argument("--pairs", type=parse_pairs,
+                        help="TX:RX ID pairs, e.g. 7E0:7E8,7E1:7E9 (overrides --sessions)")
+    parser.add_argument("--sessions", type=int, default=1,
+                        help="Number of testers on 7E0+n / 7E8+n")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("3E=4,22=3,19=2,10=1"),
+                        help="SID=weight list (hex SIDs)")
+    parser.add_argument("--rate", type=positive_float, default=10.0, help="Requests/s per session")
+    parser.add_argument("--duration", type=positive_float, default=120.0, help="Seconds to run")
+    parser.add_argument("--bus-load", type=non_negative_float, default=0.0, help="Background frames/s")
+    parser.add_argument("--report-interval", type=positive_float, default=10.0)
+    parser.add_argument("--framing", choices=["raw", "isotp"], default="raw",
+                        help="raw = uds_server.py, isotp = second_server_uds.py")
+    parser.add_argument("--csv", help="Also write one row per report interval to this file")
+    args = parser.parse_args()
+
+    pairs = args.pairs or [(0x7E0 + n, 0x7E8 + n) for n in range(args.sessions)]
+    overlap = {tx for tx, _ in pairs} & {rx for _, rx in pairs}
+    if overlap:
+        # e.g. --sessions 9: session 8 would transmit on session 0's response ID
+        parser.error("TX and RX IDs overlap: " + ", ".join(f"{i:03X}" for i in sorted(overlap)))
+    extra = [tx for tx, rx in pairs if (tx, rx) != (0x7E0, 0x7E8)]
+    if extra and args.framing == "isotp":
+        print("WARNING: second_server_uds.py only answers 7E0 → 7E8; other pairs will time out\n")
+    elif any(rx != tx + 8 for tx, rx in pairs):
+        print("WARNING: uds_server.py answers each request ID on ID + 8; other pairs will time out\n")
+    elif extra:
+        print("NOTE: every pair needs an ECU – e.g. python3 uds_server.py "
+              + " ".join(f"{tx:03X}" for tx, _ in pairs) + "\n")
+    stats = Stats()
+    stop = threading.Event()
+
+    sessions = [TesterSession(args, tx, rx, args.mix, stats, stop) for tx, rx in pairs]
+    threads = list(sessions)
+    if args.bus_load > 0:
+        reserved = {i for pair in pairs for i in pair}
+        threads.append(threading.Thread(target=background_traffic, args=(args, stop, reserved), daemon=True))
+
+    print(f"UDS load: {len(sessions)} session(s) × {args.rate:g} req/s for {args.duration:g} s, "
+          f"background {args.bus_load:g} frames/s\n")
+    header = ["t", "sent", "req/s", "positive", "negative", "timeouts", "late", "errors", "pending78",
+              "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    row_format = "{:>6} {:>6} {:>7} {:>8} {:>8} {:>8} {:>5} {:>6} {:>9} {:>7} {:>7} {:>7} {:>7}"
+    print(row_format.format(*header))
+
+    writer = None
+    csv_file = open(args.csv, "w", newline="") if args.csv else None
+    if csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+
+    totals = Stats()
+    dead = set()
+    start = last = time.time()
+    for t in threads:
+        t.start()
+    try:
+        while time.time() - start < args.duration:
+            time.sleep(min(args.report_interval, max(0.0, args.duration - (time.time() - start))))
+            snap = stats.snapshot()
+            now = time.time()
+            elapsed, last = max(now - last, 1e-6), now
+            lat = snap["latencies"]
+            with totals.lock:
+                for key in ("sent", "positive", "negative", "timeouts", "late", "errors", "pending"):
+                    setattr(totals, key, getattr(totals, key) + snap[key])
+                totals.latencies.extend(lat)
+            row = [round(now - start), snap["sent"], round(snap["sent"] / elapsed, 1),
+                   snap["positive"], snap["negative"], snap["timeouts"], snap["late"], snap["errors"], snap["pending"]]
+            row += [round(percentile(lat, p) * 1000, 1) for p in (50, 95, 99, 100)]
+            print(row_format.format(*row))
+            if writer:
+                writer.writerow(row)
+            for session in sessions:
+                if session not in dead and not session.is_alive():
+                    dead.add(session)
+                    print(f"WARNING: session 0x{session.tx_id:03X} → 0x{session.rx_id:03X} has died; "
+                          f"{len(sessions) - len(dead)} session(s) left")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for t in threads:
+            t.join(timeout=P2_STAR_CLIENT + 1)
+        if csv_file:
+            csv_file.close()
+
+    total = totals.snapshot()
+    lat = total["latencies"]
+    sent = max(total["sent"], 1)
+    print(f"\nTotal: {total['sent']} requests, {total['positive']} positive, {total['negative']} negative, "
+          f"{total['timeouts']} timeouts ({100 * total['timeouts'] / sent:.2f}%), "
+          f"{total['late']} late responses, "
+          f"{total['errors']} framing/TX errors ({100 * total['errors'] / sent:.2f}%)")
+    if dead:
+        print(f"WARNING: {len(dead)} session(s) died during the run – rates above are understated")
+    print("Latency ms: " + ", ".join(f"p{p}={percentile(lat, p) * 1000:.1f}" for p in (50, 90, 95, 99, 100)))
+
+
+if __name__ == "__main__":
+    main()
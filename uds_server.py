@@ -1,16 +1,58 @@
 #!/usr/bin/env python3
 import can
+import hashlib
+import sys
+import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
-bus = can.interface.Bus(channel='vcan0', bustype='socketcan', can_filters=[{"can_id": 0x7E0, "can_mask": 0x7FF}])
+# Physical request IDs to serve (hex on the command line, default 7E0); each is answered on ID + 8
+REQUEST_IDS = [int(arg, 16) for arg in sys.argv[1:]] or [0x7E0]
+response_id = 0x7E8             # Response ID of the tester currently being served
 
+bus = can.interface.Bus(channel='vcan0', bustype='socketcan',
+                        can_filters=[{"can_id": can_id, "can_mask": 0x7FF} for can_id in REQUEST_IDS])
 
-# Flashing simulation
-flash_address = 0
-flash_memory = bytearray()      # Will hold the received firmware
+
+# Flashing simulation – the flash image is persisted in flash.bin across runs
+FLASH_FILE = 'flash.bin'
+FLASH_BASE = 0x08010000
+FLASH_SIZE = 0x10000            # 64 KB application area
+FLASH_SECTOR_SIZE = 1024        # Smallest erasable unit
+FLASH_SECTOR_COUNT = FLASH_SIZE // FLASH_SECTOR_SIZE
+FLASH_ERASE_TIME = 0.02         # Simulated erase time per sector (s)
+FLASH_BLOCK_SIZE = FLASH_SECTOR_SIZE  # One block hash (DID F1A0) per sector
+FLASH_HASH_LENGTH = 8           # Truncated SHA-256 per block
+
+flash_address = 0               # Start address of the current download segment
+flash_memory = bytearray(b'\xFF' * FLASH_SIZE)
 expected_length = 0
+received_length = 0
 max_block_length = 4095         # We support up to 4095 bytes per TransferData
 flashing_active = False
+
+try:
+    with open(FLASH_FILE, 'rb') as f:
+        stored = f.read(FLASH_SIZE)
+    flash_memory[:len(stored)] = stored
+except FileNotFoundError:
+    stored = b''
+if len(stored) != FLASH_SIZE:
+    # Pad the persisted image once so later updates can seek+write single sectors
+    with open(FLASH_FILE, 'wb') as f:
+        f.write(flash_memory)
+
+# Sector table: blank sectors start out erased; a sector stays writable until the
+# download that programs it is closed by 0x37 (program once per erase)
+erased_sectors = {n for n in range(FLASH_SECTOR_COUNT)
+                  if flash_memory[n*FLASH_SECTOR_SIZE:(n+1)*FLASH_SECTOR_SIZE].count(0xFF) == FLASH_SECTOR_SIZE}
+programmed_sectors = set()      # Written by the current download
+dirty_sectors = set()           # Changed in RAM, not yet written back to flash.bin
+
+# Multi-frame request reassembly (uds_client.py send_uds_long: FF = 10 LL LL + 5 bytes)
+rx_states = {}                  # request ID → {"buffer", "expected", "seq"} while reassembling
+
 memory = {0xF190: b'VIN12345678901234'}
 
 
@@ -35,220 +77,438 @@ extended_data = {
     0x042000: {0x01: 45},
 }
 
-def send_response(data):
+# Routine Control (0x31): routines run on worker threads so the receive loop
+# keeps serving 3E/22/19 while an erase, checksum or self-test is in progress.
+P2_STAR_SERVER_MAX = 5.0                            # Max gap between 0x78 and the next response
+RESPONSE_PENDING_INTERVAL = P2_STAR_SERVER_MAX * 0.4  # Re-send 0x78 well inside P2*
+ROUTINE_POLL_INTERVAL = 0.01      # bus.recv timeout while routines run, so they are reported promptly
+
+# routineInfo byte returned in 71 01 / 71 03 responses
+ROUTINE_RUNNING = 0x01
+ROUTINE_COMPLETED = 0x02
+ROUTINE_STOPPED = 0x03
+ROUTINE_FAILED = 0x04
+
+routine_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="routine")
+active_routines = {}    # routine ID → {"future", "stop", "last_pending", "response_id"}
+routine_results = {}    # routine ID → (routineInfo, statusRecord) of the last run
+
+
+def routine_self_test(stop, option_record):
+    """Simulated self-test: 3 steps of 1 s each, abortable via 31 02"""
+    for step in range(3):
+        if stop.wait(1.0):
+            return ROUTINE_STOPPED, bytes([step])
+    return ROUTINE_COMPLETED, bytes([3])
+
+
+def routine_checksum(stop, option_record):
+    """CRC32 over the flash image, computed off the receive loop"""
+    image = bytes(flash_memory)
+    crc = 0
+    for i in range(0, len(image), 1024):
+        if stop.is_set():
+            return ROUTINE_STOPPED, b''
+        crc = zlib.crc32(image[i:i+1024], crc)
+    return ROUTINE_COMPLETED, crc.to_bytes(4, 'big')
+
+
+def erase_range(option_record):
+    """EraseMemory option record: [addressAndLengthFormatIdentifier] [address] [size] → sectors, or None"""
+    if not option_record:
+        return None
+    size_len = option_record[0] >> 4
+    addr_len = option_record[0] & 0x0F
+    if not size_len or not addr_len or len(option_record) != 1 + addr_len + size_len:
+        return None
+    address = int.from_bytes(option_record[1:1+addr_len], 'big')
+    length = int.from_bytes(option_record[1+addr_len:], 'big')
+    if not length or address < FLASH_BASE or address + length > FLASH_BASE + FLASH_SIZE:
+        return None
+    first = (address - FLASH_BASE) // FLASH_SECTOR_SIZE
+    last = (address - FLASH_BASE + length - 1) // FLASH_SECTOR_SIZE
+    return range(first, last + 1)
+
+
+def routine_erase_memory(stop, option_record):
+    """Erase every sector touched by the address/length in the option record"""
+    erased = 0
+    for sector in erase_range(option_record):
+        if stop.is_set():
+            return ROUTINE_STOPPED, erased.to_bytes(2, 'big')
+        offset = sector * FLASH_SECTOR_SIZE
+        flash_memory[offset:offset+FLASH_SECTOR_SIZE] = b'\xFF' * FLASH_SECTOR_SIZE
+        erased_sectors.add(sector)
+        dirty_sectors.add(sector)
+        erased += 1
+        time.sleep(FLASH_ERASE_TIME)
+    return ROUTINE_COMPLETED, erased.to_bytes(2, 'big')
+
+
+def persist_dirty_sectors():
+    """Write back only the sectors changed since the last flush"""
+    if not dirty_sectors:
+        return
+    with open(FLASH_FILE, 'r+b') as f:
+        for sector in sorted(dirty_sectors):
+            offset = sector * FLASH_SECTOR_SIZE
+            f.seek(offset)
+            f.write(flash_memory[offset:offset+FLASH_SECTOR_SIZE])
+    print(f"[ECU] Persisted {len(dirty_sectors)} dirty sector(s) to {FLASH_FILE}")
+    dirty_sectors.clear()
+
+
+# Routine ID → worker function(stop_event, optionRecord) → (routineInfo, statusRecord)
+routines = {
+    0xFFFB: routine_self_test,
+    0xFF01: routine_checksum,
+    0xFF00: routine_erase_memory,
+}
+
+
+def service_routines():
+    """Send the final 71 01 for finished routines and keep 0x78 alive for running ones"""
+    now = time.time()
+    for routine_id, routine in list(active_routines.items()):
+        rid = routine_id.to_bytes(2, 'big')
+        if routine["future"].done():
+            try:
+                info, record = routine["future"].result()
+            except Exception as exc:
+                print(f"[ECU] Routine {routine_id:04X} failed: {exc}")
+                info, record = ROUTINE_FAILED, b''
+            routine_results[routine_id] = (info, record)
+            del active_routines[routine_id]
+            if routine_id == 0xFF00:
+                persist_dirty_sectors()
+            send_response(bytes([0x71, 0x01]) + rid + bytes([info]) + record, routine["response_id"])
+            print(f"[ECU] → 71 01 {routine_id:04X} Routine finished (info 0x{info:02X})")
+        elif now - routine["last_pending"] >= RESPONSE_PENDING_INTERVAL:
+            send_response(bytes([0x7F, 0x31, 0x78]), routine["response_id"])
+            routine["last_pending"] = now
+
+
+def flash_block_hashes():
+    """DID F1A0: base address, block size, then one truncated SHA-256 per flash block"""
+    resp = bytearray(FLASH_BASE.to_bytes(4, 'big'))
+    resp.extend(FLASH_BLOCK_SIZE.to_bytes(2, 'big'))
+    view = memoryview(flash_memory)
+    for offset in range(0, FLASH_SIZE, FLASH_BLOCK_SIZE):
+        resp.extend(hashlib.sha256(view[offset:offset+FLASH_BLOCK_SIZE]).digest()[:FLASH_HASH_LENGTH])
+    return bytes(resp)
+
+
+def send_response(data, can_id=None):
+    can_id = can_id or response_id
     if len(data) <= 8:
-        bus.send(can.Message(arbitration_id=0x7E8, data=data, is_extended_id=False))
+        bus.send(can.Message(arbitration_id=can_id, data=data, is_extended_id=False))
         
         return
     first_frame = bytearray([0x10 | (len(data) >> 8), len(data) & 0xFF]) + data[:6]
-    bus.send(can.Message(arbitration_id=0x7E8, data=first_frame, is_extended_id=False))
+    bus.send(can.Message(arbitration_id=can_id, data=first_frame, is_extended_id=False))
     time.sleep(0.05)
     remaining = data[6:]
     seq = 0x21
     for i in range(0, len(remaining), 7):
         chunk = remaining[i:i+7]
         frame = bytearray([seq]) + chunk + b'\x00'*(7-len(chunk))
-        bus.send(can.Message(arbitration_id=0x7E8, data=frame[:8], is_extended_id=False))
+        bus.send(can.Message(arbitration_id=can_id, data=frame[:8], is_extended_id=False))
         
         seq = 0x20 if seq == 0x2F else seq + 1
         time.sleep(0.01)
 
-print("Virtual ECU listening on vcan0 (0x7E0 → 0x7E8) – multi-frame ready")
-
-while True:
-    msg = bus.recv(timeout=10)
-    if not msg or msg.arbitration_id != 0x7E0:
-        continue
-    data = msg.data
-    sid = data[0]
-
-    # ------------------ BASIC SERVICES ------------------
-    if sid == 0x10:
-        print(f"[ECU] ← 10 {data[1]:02X} Extended session")
-        send_response(bytes([0x50, data[1]]))
-        continue
-
-    if sid == 0x27 and data[1] == 0x01:
-        print("[ECU] ← 27 01 Request seed → sending CAFEBABE")
-        send_response(bytes([0x67, 0x01, 0xCA, 0xFE, 0xBA, 0xBE]))
-        continue
-    if sid == 0x27 and data[1] == 0x02:
-        if len(data) >= 6 and data[2:6] == b'\x12\x34\x56\x78':
-            print("[ECU] ← 27 02 Key correct → ACCESS GRANTED")
-            send_response(bytes([0x67, 0x02]))
-        else:
-            print("[ECU] ← 27 02 Wrong key!")
-            send_response(bytes([0x7F, 0x27, 0x35]))
-        continue
-
-    if sid == 0x22:
-        did = (data[1] << 8) | data[2]
-        print(f"[ECU] ← 22 {did:04X} Read DID")
-        if did == 0xF190:
-            resp = bytes([0x62, data[1], data[2]]) + memory[0xF190]
-            send_response(resp)
-        else:
-            send_response(bytes([0x7F, 0x22, 0x31]))
-        continue
-
-    if sid == 0x3E:
-        print("[ECU] ← 3E 00 Tester present")
-        send_response(bytes([0x7E, 0x00]))
-        continue
-
-    # ------------------ 0x19 DTC SERVICES ------------------
-    if sid == 0x19:
-        if len(data) < 2:
-            send_response(bytes([0x7F, 0x19, 0x13]))
+ids = ', '.join(f"0x{can_id:03X} → 0x{can_id + 8:03X}" for can_id in REQUEST_IDS)
+print(f"Virtual ECU listening on vcan0 ({ids}) – multi-frame ready")
+
+try:
+    while True:
+        msg = bus.recv(timeout=ROUTINE_POLL_INTERVAL if active_routines else 10)
+        service_routines()
+        if not msg or msg.arbitration_id not in REQUEST_IDS:
             continue
-        subfunc = data[1]
-        print(f"[ECU] ← 19 {subfunc:02X} Read DTC Information")
+        data = msg.data
+        response_id = msg.arbitration_id + 8
 
-        if subfunc == 0x01:  # Number of DTC by Status Mask
-            mask = data[2] if len(data) >= 3 else 0xFF
-            count = sum(1 for s in dtc_memory.values() if (s & mask))
-            resp = bytearray([0x59, 0x01, 0xFF, 0x02]) + count.to_bytes(2, 'big')
-            send_response(resp)
-            print(f"[ECU] → 59 01 DTC count = {count} (mask 0x{mask:02X})")
+        # ------------------ Multi-frame requests ------------------
+        if len(data) == 8 and data[0] == 0x10:  # First frame
+            rx_states[msg.arbitration_id] = {"buffer": bytearray(data[3:8]),
+                                             "expected": (data[1] << 8) | data[2], "seq": 0x21}
+            continue
+        if len(data) == 8 and data[0] >> 4 == 0x2:  # Consecutive frame
+            rx = rx_states.get(msg.arbitration_id)
+            if rx is None:
+                continue  # No reassembly in progress for this tester – never dispatch a CF
+            if data[0] != rx["seq"]:
+                print(f"[ECU] CF sequence error from 0x{msg.arbitration_id:03X}: got {data[0]:02X}, "
+                      f"expected {rx['seq']:02X} – request dropped")
+                del rx_states[msg.arbitration_id]
+                continue
+            rx["buffer"].extend(data[1:8])
+            rx["seq"] = 0x20 if rx["seq"] == 0x2F else rx["seq"] + 1
+            if len(rx["buffer"]) < rx["expected"]:
+                continue
+            data = bytes(rx["buffer"][:rx["expected"]])
+            del rx_states[msg.arbitration_id]
+        sid = data[0]
+
+        # ------------------ BASIC SERVICES ------------------
+        if sid == 0x10:
+            print(f"[ECU] ← 10 {data[1]:02X} Extended session")
+            send_response(bytes([0x50, data[1]]))
             continue
 
-        if subfunc == 0x02:  # Report DTC by Status Mask
-            mask = data[2] if len(data) >= 3 else 0xFF
-            matching = [(d, s) for d, s in dtc_memory.items() if (s & mask)]
-            payload = bytearray([0x59, 0x02, 0xFF, 0x02])
-            for d, s in matching:
-                payload.extend(d.to_bytes(3, 'big'))
-                payload.append(s)
-            send_response(payload)
-            print(f"[ECU] → 59 02 Reported {len(matching)} DTC(s): {[f'P{d:04X}' for d,_ in matching]}")
+        if sid == 0x27 and data[1] == 0x01:
+            print("[ECU] ← 27 01 Request seed → sending CAFEBABE")
+            send_response(bytes([0x67, 0x01, 0xCA, 0xFE, 0xBA, 0xBE]))
+            continue
+        if sid == 0x27 and data[1] == 0x02:
+            if len(data) >= 6 and data[2:6] == b'\x12\x34\x56\x78':
+                print("[ECU] ← 27 02 Key correct → ACCESS GRANTED")
+                send_response(bytes([0x67, 0x02]))
+            else:
+                print("[ECU] ← 27 02 Wrong key!")
+                send_response(bytes([0x7F, 0x27, 0x35]))
             continue
 
-        if subfunc == 0x04:  # Snapshot
-            if len(data) < 6:
-                send_response(bytes([0x7F, 0x19, 0x13]))
-                continue
-            dtc = (data[2] << 16) | (data[3] << 8) | data[4]
-            rec = data[5]
-            if dtc not in snapshot_data or rec not in snapshot_data[dtc]:
-                send_response(bytes([0x7F, 0x19, 0x10]))
-                continue
-            payload = bytearray([0x59, 0x04]) + dtc.to_bytes(3, 'big') + bytes([rec])
-            for did, val in snapshot_data[dtc][rec].items():
-                payload.append(did)
-                payload.extend(val.to_bytes(2, 'big'))
-            send_response(payload)
-            print(f"[ECU] → 59 04 Snapshot for P{dtc:04X} (Rec 0x{rec:02X}): RPM={snapshot_data[dtc][rec].get(0x04)}")
+        if sid == 0x22:
+            did = (data[1] << 8) | data[2]
+            print(f"[ECU] ← 22 {did:04X} Read DID")
+            if did == 0xF190:
+                resp = bytes([0x62, data[1], data[2]]) + memory[0xF190]
+                send_response(resp)
+            elif did == 0xF1A0 and 0xFF00 in active_routines:
+                send_response(bytes([0x7F, 0x22, 0x22]))  # conditionsNotCorrect: image half-erased
+            elif did == 0xF1A0:  # Flash block hashes for differential flashing
+                send_response(bytes([0x62, data[1], data[2]]) + flash_block_hashes())
+            else:
+                send_response(bytes([0x7F, 0x22, 0x31]))
             continue
 
-        if subfunc == 0x06:  # Extended Data
-            if len(data) < 6:
+        if sid == 0x3E:
+            print("[ECU] ← 3E 00 Tester present")
+            send_response(bytes([0x7E, 0x00]))
+            continue
+
+        # ------------------ 0x19 DTC SERVICES ------------------
+        if sid == 0x19:
+            if len(data) < 2:
                 send_response(bytes([0x7F, 0x19, 0x13]))
                 continue
-            dtc = (data[2] << 16) | (data[3] << 8) | data[4]
-            rec = data[5]
-            if dtc not in extended_data or rec not in extended_data[dtc]:
-                send_response(bytes([0x7F, 0x19, 0x10]))
+            subfunc = data[1]
+            print(f"[ECU] ← 19 {subfunc:02X} Read DTC Information")
+
+            if subfunc == 0x01:  # Number of DTC by Status Mask
+                mask = data[2] if len(data) >= 3 else 0xFF
+                count = sum(1 for s in dtc_memory.values() if (s & mask))
+                resp = bytearray([0x59, 0x01, 0xFF, 0x02]) + count.to_bytes(2, 'big')
+                send_response(resp)
+                print(f"[ECU] → 59 01 DTC count = {count} (mask 0x{mask:02X})")
+                continue
+
+            if subfunc == 0x02:  # Report DTC by Status Mask
+                mask = data[2] if len(data) >= 3 else 0xFF
+                matching = [(d, s) for d, s in dtc_memory.items() if (s & mask)]
+                payload = bytearray([0x59, 0x02, 0xFF, 0x02])
+                for d, s in matching:
+                    payload.extend(d.to_bytes(3, 'big'))
+                    payload.append(s)
+                send_response(payload)
+                print(f"[ECU] → 59 02 Reported {len(matching)} DTC(s): {[f'P{d:04X}' for d,_ in matching]}")
+                continue
+
+            if subfunc == 0x04:  # Snapshot
+                if len(data) < 6:
+                    send_response(bytes([0x7F, 0x19, 0x13]))
+                    continue
+                dtc = (data[2] << 16) | (data[3] << 8) | data[4]
+                rec = data[5]
+                if dtc not in snapshot_data or rec not in snapshot_data[dtc]:
+                    send_response(bytes([0x7F, 0x19, 0x10]))
+                    continue
+                payload = bytearray([0x59, 0x04]) + dtc.to_bytes(3, 'big') + bytes([rec])
+                for did, val in snapshot_data[dtc][rec].items():
+                    payload.append(did)
+                    payload.extend(val.to_bytes(2, 'big'))
+                send_response(payload)
+                print(f"[ECU] → 59 04 Snapshot for P{dtc:04X} (Rec 0x{rec:02X}): RPM={snapshot_data[dtc][rec].get(0x04)}")
+                continue
+
+            if subfunc == 0x06:  # Extended Data
+                if len(data) < 6:
+                    send_response(bytes([0x7F, 0x19, 0x13]))
+                    continue
+                dtc = (data[2] << 16) | (data[3] << 8) | data[4]
+                rec = data[5]
+                if dtc not in extended_data or rec not in extended_data[dtc]:
+                    send_response(bytes([0x7F, 0x19, 0x10]))
+                    continue
+                payload = bytearray([0x59, 0x06]) + dtc.to_bytes(3, 'big') + bytes([rec, 0x01, extended_data[dtc][rec]])
+                send_response(payload)
+                print(f"[ECU] → 59 06 Extended data for P{dtc:04X}: occurrence={extended_data[dtc][rec]}")
                 continue
-            payload = bytearray([0x59, 0x06]) + dtc.to_bytes(3, 'big') + bytes([rec, 0x01, extended_data[dtc][rec]])
-            send_response(payload)
-            print(f"[ECU] → 59 06 Extended data for P{dtc:04X}: occurrence={extended_data[dtc][rec]}")
-            continue
 
-        send_response(bytes([0x7F, 0x19, 0x12]))  # sub-function not supported
-        continue
+            send_response(bytes([0x7F, 0x19, 0x12]))  # sub-function not supported
+            continue
     
 
-        # ------------------ ECU Reset (0x11) ------------------
-    if sid == 0x11:
-        subfunc = data[1]
-        if subfunc in [0x01, 0x03]:
-            print(f"[ECU] ← 11 {subfunc:02X} ECU Reset requested")
-            # Positive response: 0x51 + subfunction
-            send_response(bytes([0x51, subfunc]))
-            print("[ECU] → 51 {:02X} Resetting ECU... (simulated)".format(subfunc))
-            if subfunc == 0x01:
-                print("[ECU] Simulated power-on reset – all sessions lost")
+            # ------------------ ECU Reset (0x11) ------------------
+        if sid == 0x11:
+            subfunc = data[1]
+            if subfunc in [0x01, 0x03]:
+                print(f"[ECU] ← 11 {subfunc:02X} ECU Reset requested")
+                # Positive response: 0x51 + subfunction
+                send_response(bytes([0x51, subfunc]))
+                print("[ECU] → 51 {:02X} Resetting ECU... (simulated)".format(subfunc))
+                if subfunc == 0x01:
+                    print("[ECU] Simulated power-on reset – all sessions lost")
+                else:
+                    print("[ECU] Reset complete – diagnostic session preserved")
             else:
-                print("[ECU] Reset complete – diagnostic session preserved")
-        else:
-            send_response(bytes([0x7F, 0x11, 0x12]))  # subFunctionNotSupported
-        continue
-
-    # ------------------ Routine Control (0x31) ------------------
-    if sid == 0x31:
-        if len(data) < 4:
-            send_response(bytes([0x7F, 0x31, 0x13]))
+                send_response(bytes([0x7F, 0x11, 0x12]))  # subFunctionNotSupported
             continue
-        subfunc = data[1]
-        routine_id = (data[2] << 8) | data[3]
-        print(f"[ECU] ← 31 {subfunc:02X} {routine_id:04X} Routine Control")
-
-        if routine_id == 0xFFFB:  # Self-test / Clear DTCs
-            if subfunc == 0x01:
-                print("[ECU] Starting self-test routine...")
-                send_response(bytes([0x71, 0x01, 0xFF, 0xFB]))
-                print("[ECU] → 71 01 FFFB Self-test started")
-            elif subfunc == 0x03:
-                print("[ECU] Stopping self-test routine...")
-                send_response(bytes([0x71, 0x03, 0xFF, 0xFB]))
-                print("[ECU] → 71 03 FFFB Self-test stopped")
+
+        # ------------------ Routine Control (0x31) ------------------
+        if sid == 0x31:
+            if len(data) < 4:
+                send_response(bytes([0x7F, 0x31, 0x13]))
+                continue
+            subfunc = data[1]
+            routine_id = (data[2] << 8) | data[3]
+            print(f"[ECU] ← 31 {subfunc:02X} {routine_id:04X} Routine Control")
+
+            if routine_id not in routines:
+                send_response(bytes([0x7F, 0x31, 0x31]))  # requestOutOfRange
+                continue
+            rid = routine_id.to_bytes(2, 'big')
+
+            if subfunc == 0x01:  # startRoutine → 0x78 now, 71 01 when the worker finishes
+                if routine_id in active_routines:
+                    send_response(bytes([0x7F, 0x31, 0x22]))  # conditionsNotCorrect
+                    continue
+                download_open = flashing_active or bool(programmed_sectors)  # Open until 0x37
+                if routine_id == 0xFF00 and (download_open or erase_range(data[4:]) is None):
+                    send_response(bytes([0x7F, 0x31, 0x22 if download_open else 0x31]))
+                    continue
+                stop = threading.Event()
+                future = routine_executor.submit(routines[routine_id], stop, bytes(data[4:]))
+                active_routines[routine_id] = {"future": future, "stop": stop, "last_pending": time.time(),
+                                           "response_id": response_id}
+                routine_results.pop(routine_id, None)
+                send_response(bytes([0x7F, 0x31, 0x78]))  # requestCorrectlyReceived-ResponsePending
+                print(f"[ECU] → 7F 31 78 Routine {routine_id:04X} started (response pending)")
+            elif subfunc == 0x02:  # stopRoutine
+                if routine_id not in active_routines:
+                    send_response(bytes([0x7F, 0x31, 0x24]))  # requestSequenceError
+                    continue
+                active_routines[routine_id]["stop"].set()
+                send_response(bytes([0x71, 0x02]) + rid)
+                print(f"[ECU] → 71 02 {routine_id:04X} Stop requested")
+            elif subfunc == 0x03:  # requestRoutineResults
+                if routine_id in active_routines:
+                    send_response(bytes([0x71, 0x03]) + rid + bytes([ROUTINE_RUNNING]))
+                elif routine_id in routine_results:
+                    info, record = routine_results[routine_id]
+                    send_response(bytes([0x71, 0x03]) + rid + bytes([info]) + record)
+                else:
+                    send_response(bytes([0x7F, 0x31, 0x24]))  # requestSequenceError
+                    continue
+                print(f"[ECU] → 71 03 {routine_id:04X} Routine results")
             else:
                 send_response(bytes([0x7F, 0x31, 0x12]))
-        else:
-            send_response(bytes([0x7F, 0x31, 0x31]))  # requestOutOfRange
-        continue
-
-        # ------------------ 0x34 Request Download ------------------
-    if sid == 0x34:
-        if len(data) < 6:
-            send_response(bytes([0x7F, 0x34, 0x13]))
             continue
-        print(f"[ECU] ← 34 00 Request Download")
-
-        # Parse length and address (simplified: assume 4-byte len + 4-byte addr)
-        length = int.from_bytes(data[2:6], 'big')
-        address = int.from_bytes(data[6:10], 'big') if len(data) >= 10 else 0x08010000
-
-        flash_address = address
-        expected_length = length
-        flash_memory = bytearray()  # Reset buffer
-        flashing_active = True
-
-        # Response: 74 00 [maxNumberOfBlockLength (2 bytes)]
-        resp = bytearray([0x74, 0x00])
-        resp.extend(max_block_length.to_bytes(2, 'big'))
-        send_response(resp)
-        print(f"[ECU] → 74 00 Download accepted: {length} bytes @ 0x{address:08X}")
-        print(f"[ECU] Ready to receive {length} bytes (max {max_block_length} per block)")
-        continue
-
-    # ------------------ 0x36 Transfer Data ------------------
-    if sid == 0x36:
-        if not flashing_active:
-            send_response(bytes([0x7F, 0x36, 0x24]))  # requestSequenceError
+
+            # ------------------ 0x34 Request Download ------------------
+        if sid == 0x34:
+            # 34 [dataFormatIdentifier] [addressAndLengthFormatIdentifier] [address] [size]
+            if len(data) < 3:
+                send_response(bytes([0x7F, 0x34, 0x13]))
+                continue
+            size_len = data[2] >> 4
+            addr_len = data[2] & 0x0F
+            if len(data) != 3 + addr_len + size_len:
+                send_response(bytes([0x7F, 0x34, 0x13]))
+                continue
+            print(f"[ECU] ← 34 00 Request Download")
+
+            address = int.from_bytes(data[3:3+addr_len], 'big')
+            length = int.from_bytes(data[3+addr_len:], 'big')
+            if address < FLASH_BASE or address + length > FLASH_BASE + FLASH_SIZE:
+                send_response(bytes([0x7F, 0x34, 0x31]))  # requestOutOfRange
+                print(f"[ECU] → 7F 34 31 {length} bytes @ 0x{address:08X} outside flash")
+                continue
+            if 0xFF00 in active_routines:
+                send_response(bytes([0x7F, 0x34, 0x22]))  # conditionsNotCorrect: erase running
+                continue
+
+            erased_sectors.difference_update(programmed_sectors)
+            programmed_sectors.clear()
+
+            flash_address = address
+            expected_length = length
+            received_length = 0
+            flashing_active = True
+
+            # Response: 74 20 [maxNumberOfBlockLength (2 bytes)]
+            resp = bytearray([0x74, 0x20])
+            resp.extend(max_block_length.to_bytes(2, 'big'))
+            send_response(resp)
+            print(f"[ECU] → 74 20 Download accepted: {length} bytes @ 0x{address:08X}")
+            print(f"[ECU] Ready to receive {length} bytes (max {max_block_length} per block)")
             continue
 
-        seq_num = data[1]
-        chunk = data[2:]
+        # ------------------ 0x36 Transfer Data ------------------
+        if sid == 0x36:
+            if not flashing_active:
+                send_response(bytes([0x7F, 0x36, 0x24]))  # requestSequenceError
+                continue
 
-        flash_memory.extend(chunk)
-        received = len(flash_memory)
-        print(f"[ECU] ← 36 {seq_num:02X} Received chunk {len(chunk)} bytes → Total: {received}/{expected_length}")
+            seq_num = data[1]
+            chunk = data[2:]
+            if received_length + len(chunk) > expected_length:
+                send_response(bytes([0x7F, 0x36, 0x71]))  # transferDataSuspended
+                continue
 
-        # Positive response: 76 + sequence number
-        send_response(bytes([0x76, seq_num]))
+            offset = flash_address - FLASH_BASE + received_length
+            sectors = set(range(offset // FLASH_SECTOR_SIZE, (offset + len(chunk) - 1) // FLASH_SECTOR_SIZE + 1))
+            if chunk and not sectors <= erased_sectors:
+                first = min(sectors - erased_sectors)
+                print(f"[ECU] → 7F 36 72 Sector {first} @ 0x{FLASH_BASE + first * FLASH_SECTOR_SIZE:08X} not erased")
+                send_response(bytes([0x7F, 0x36, 0x72]))  # generalProgrammingFailure
+                continue
+            flash_memory[offset:offset+len(chunk)] = chunk
+            programmed_sectors.update(sectors)
+            dirty_sectors.update(sectors)
+            received_length += len(chunk)
+            print(f"[ECU] ← 36 {seq_num:02X} Received chunk {len(chunk)} bytes → Total: {received_length}/{expected_length}")
+
+            # Positive response: 76 + sequence number
+            send_response(bytes([0x76, seq_num]))
+
+            if received_length >= expected_length:
+                print(f"[ECU] SEGMENT COMPLETE! {received_length} bytes written to 0x{flash_address:08X}")
+                flashing_active = False
+            continue
 
-        if received >= expected_length:
-            print(f"[ECU] FLASHING COMPLETE! {received} bytes written to 0x{flash_address:08X}")
+        # ------------------ 0x37 Request Transfer Exit ------------------
+        if sid == 0x37:
+            if 0xFF00 in active_routines:
+                # The erase worker still adds dirty sectors – persisting now would drop them
+                send_response(bytes([0x7F, 0x37, 0x22]))  # conditionsNotCorrect
+                continue
+            if flashing_active:
+                print(f"[ECU] ← 37 Request Transfer Exit (partial)")
+            else:
+                print(f"[ECU] ← 37 Request Transfer Exit – {received_length} bytes flashed")
+            erased_sectors.difference_update(programmed_sectors)
+            programmed_sectors.clear()
+            persist_dirty_sectors()
+            send_response(bytes([0x77]))
             flashing_active = False
-        continue
-
-    # ------------------ 0x37 Request Transfer Exit ------------------
-    if sid == 0x37:
-        if flashing_active:
-            print(f"[ECU] ← 37 Request Transfer Exit (partial)")
-        else:
-            print(f"[ECU] ← 37 Request Transfer Exit – {len(flash_memory)} bytes flashed")
-        send_response(bytes([0x77]))
-        flashing_active = False
-        continue
\ No newline at end of file
+            continue
+except KeyboardInterrupt:
+    print("\n[ECU] Shutting down")
+finally:
+    # Abort running routines instead of waiting for them on exit
+    for routine in active_routines.values():
+        routine["stop"].set()
+    routine_executor.shutdown(wait=False, cancel_futures=True)